@@ -1,29 +1,58 @@
 """
 WILDLIFE MONITOR - RASPBERRY PI CONTROLLER (FINAL)
 -------------------------------------------------
-Connects to MQTT, waits for a trigger, records video,
-runs AI detection, saves to DB, and sends notifications.
+Connects to MQTT, waits for a trigger, runs AI detection on
+a preview frame, records video of confirmed animals, saves
+to DB, and sends notifications.
 """
 import paho.mqtt.client as mqtt
-import json
-import subprocess
+import cv2
+import numpy as np
+import orjson
 import os
 import sqlite3
+import queue
 import requests
+import threading
 import time
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime
+from numba import njit
+from picamera2 import Picamera2
+from picamera2.encoders import H264Encoder
+from picamera2.outputs import PyavOutput
 from ultralytics import YOLO
 
 
 # --- Configuration ---
 MQTT_BROKER = "localhost"
 MQTT_PORT = 1883
+MQTT_KEEPALIVE = 120  # seconds
 TRIGGER_TOPIC = "WILDLIFE/TRIGGER"
 NTFY_TOPIC = "wildcam_project_aus" 
-MODEL_FILE = "/home/param/yolov8n.pt"
+# NCNN export of yolov8n.pt (ARM NEON kernels, much faster than the PyTorch
+# weights on the Pi CPU). Create it once with:
+#   YOLO("/home/param/yolov8n.pt").export(format="ncnn", imgsz=320)
+MODEL_FILE = "/home/param/yolov8n_ncnn_model"
+# Int8 Edge TPU compile of the same model, used instead when a Coral
+# accelerator is attached. Create it once with:
+#   YOLO("/home/param/yolov8n.pt").export(format="edgetpu", imgsz=320)
+EDGETPU_MODEL_FILE = "/home/param/yolov8n_saved_model/yolov8n_full_integer_quant_edgetpu.tflite"
 CAPTURE_DIR = "/home/param/captures"
 DB_FILE = "/home/param/wildlife_log.db"
 VIDEO_DURATION_MS = 10000  # 10 seconds
+# An animal confirmed while a clip records is linked to that clip only if at
+# least this much of it is left; otherwise it gets its own follow-up clip
+MIN_LINKED_CLIP_MS = 3000
+FRAME_SIZE = (640, 360)  # Analysis frame, also sent with the notification
+FRAME_JPEG_QUALITY = 80
+SAVE_FRAMES = False  # Also write each analysed frame to CAPTURE_DIR as a JPEG
+# 320px is plenty to confirm an animal is in frame, at ~1/4 the work of 640px.
+# Both model exports above must be made at this size.
+DETECTION_IMGSZ = 320
+DETECTION_CONF = 0.25
+PIPELINE_QUEUE_SIZE = 4  # Triggers that can wait at each pipeline stage
+DB_FLUSH_INTERVAL_S = 2  # How often queued captures are written to the database
 
 # List of classes to consider "animals"
 ANIMAL_CLASSES = ["bird", "cat", "dog", "horse", "sheep", "cow", 
@@ -31,269 +60,459 @@ ANIMAL_CLASSES = ["bird", "cat", "dog", "horse", "sheep", "cow",
 
 # --- Global YOLO Model ---
 model = None
-# --- NEW: Global processing lock ---
-is_processing = False
+animal_mask = None  # animal_mask[class_id] is True if that class is in ANIMAL_CLASSES
+class_labels = None  # Display name for each class id, e.g. "Bird"
+# --- Global camera session ---
+camera = None
+# --- Global database connection ---
+db_conn = None
+# Rows waiting for the next batched write, so a burst of triggers costs one commit
+pending_rows = []
+pending_lock = threading.Lock()
+# --- Notification sender: keep-alive HTTP session + background workers ---
+http_session = requests.Session()
+notify_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="notify")
 
 # --- 1. Database Functions ---
+# sqlite3 caches compiled statements per connection, keyed by the SQL text,
+# so reusing this exact string on one connection reuses the prepared INSERT.
+INSERT_SQL = """
+INSERT INTO captures (timestamp, classification, confidence, video_path, 
+                      temp, humidity, battery, light_state)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
 def init_db():
-    """Initializes the database and creates the 'captures' table if it doesn't exist."""
+    """Opens the shared database connection and creates the 'captures' table if it doesn't exist."""
+    global db_conn
     print("Initializing database...")
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            cursor = conn.cursor()
-            cursor.execute("""
-            CREATE TABLE IF NOT EXISTS captures (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                timestamp TEXT NOT NULL,
-                classification TEXT NOT NULL,
-                confidence REAL,
-                video_path TEXT,
-                temp REAL,
-                humidity REAL,
-                battery INTEGER,
-                light_state INTEGER
-            );
-            """)
-            conn.commit()
-            print("Database initialized successfully.")
+        # One connection for the life of the process; autocommit mode so each
+        # statement is its own transaction without an implicit BEGIN.
+        db_conn = sqlite3.connect(DB_FILE, isolation_level=None, check_same_thread=False)
+        # WAL is persistent in the database file; it avoids a full fsync per
+        # commit and lets the dashboard read while we write.
+        db_conn.execute("PRAGMA journal_mode=WAL")
+        db_conn.execute("PRAGMA synchronous=NORMAL")
+        # Checkpoint every ~200 pages (default 1000) so each checkpoint is a
+        # small, quick write and the WAL file stays short for dashboard readers
+        db_conn.execute("PRAGMA wal_autocheckpoint=200")
+        db_conn.execute("""
+        CREATE TABLE IF NOT EXISTS captures (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            timestamp TEXT NOT NULL,
+            classification TEXT NOT NULL,
+            confidence REAL,
+            video_path TEXT,
+            temp REAL,
+            humidity REAL,
+            battery INTEGER,
+            light_state INTEGER
+        );
+        """)
+        # For dashboard queries that filter or sort by time and classification
+        db_conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_captures_ts
+            ON captures(timestamp DESC, classification);
+        """)
+        print("Database initialized successfully.")
     except Exception as e:
         print(f"Error initializing database: {e}")
 def save_to_db(data):
-    """Saves a single detection event to the database."""
-    print("Saving to database...")
+    """Queues a single detection event for the next batched database write."""
+    row = (
+        data.get('timestamp'),
+        data.get('classification'),
+        data.get('confidence'),
+        data.get('video_path'),
+        data.get('temp'),
+        data.get('humidity'),
+        data.get('battery'),
+        data.get('light_state')
+    )
+    with pending_lock:
+        pending_rows.append(row)
+    print("Data queued for database.")
+
+def flush_db():
+    """Writes all queued detection events to the database in a single transaction."""
+    global pending_rows
+    with pending_lock:
+        if not pending_rows:
+            return
+        if db_conn is None:
+            print(f"Database not initialized, keeping {len(pending_rows)} row(s) queued.")
+            return
+        try:
+            db_conn.execute("BEGIN")
+            db_conn.executemany(INSERT_SQL, pending_rows)
+            db_conn.execute("COMMIT")
+            print(f"Saved {len(pending_rows)} row(s) to database.")
+            pending_rows.clear()
+            return
+        except Exception as e:
+            print(f"Error saving batch to database, retrying row by row: {e}")
+            try:
+                if db_conn.in_transaction:
+                    db_conn.execute("ROLLBACK")
+            except Exception as e:
+                print(f"Error rolling back database batch: {e}")
+
+        # One bad row must not hold back the rest of the batch. Rows that hit
+        # an operational error (database locked, I/O) stay queued for the next
+        # flush; rows SQLite rejects outright would fail forever, so drop them.
+        retry_rows = []
+        saved = 0
+        for row in pending_rows:
+            try:
+                db_conn.execute(INSERT_SQL, row)
+                saved += 1
+            except sqlite3.OperationalError as e:
+                print(f"Error saving to database, will retry: {e}")
+                retry_rows.append(row)
+            except Exception as e:
+                print(f"Dropping row that cannot be saved {row}: {e}")
+        print(f"Saved {saved} row(s) to database.")
+        pending_rows = retry_rows
+
+def start_db_flusher():
+    """Flushes queued rows now and then every DB_FLUSH_INTERVAL_S seconds."""
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            cursor = conn.cursor()
-            cursor.execute("""
-            INSERT INTO captures (timestamp, classification, confidence, video_path, 
-                                  temp, humidity, battery, light_state)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            """, (
-                data.get('timestamp'),
-                data.get('classification'),
-                data.get('confidence'),
-                data.get('video_path'),
-                data.get('temp'),
-                data.get('humidity'),
-                data.get('battery'),
-                data.get('light_state')
-            ))
-            conn.commit()
-            print("Data saved successfully.")
+        flush_db()
     except Exception as e:
-        print(f"Error saving to database: {e}")
+        print(f"Error flushing database: {e}")
+    finally:
+        # Always schedule the next flush, so one failure can't stop the writer
+        timer = threading.Timer(DB_FLUSH_INTERVAL_S, start_db_flusher)
+        timer.daemon = True
+        timer.start()
 
 # --- 2. Core Logic ---
+def init_camera():
+    """Opens the camera once and keeps it streaming at video resolution."""
+    global camera
+    print("Starting camera...")
+    camera = Picamera2()
+    # RGB888 gives BGR-ordered arrays, which is what OpenCV and YOLO expect
+    camera.configure(camera.create_video_configuration(main={"size": (1280, 720), "format": "RGB888"}))
+    camera.start()
+    print("Camera started.")
+
+def capture_frame(frame_path=None):
+    """Grabs a still frame from the running camera for analysis, optionally saving it."""
+    global camera
+    
+    # Take the frame straight from the camera and shrink it to 640px wide,
+    # which is what the notification image needs; YOLO scales it down again
+    # to DETECTION_IMGSZ itself. It stays in memory for detection and the
+    # notification, so the SD card is only touched if we want to keep a copy.
+    try:
+        frame = cv2.resize(camera.capture_array(), FRAME_SIZE, interpolation=cv2.INTER_AREA)
+        if frame_path:
+            os.makedirs(CAPTURE_DIR, exist_ok=True)
+            cv2.imwrite(frame_path, frame, [cv2.IMWRITE_JPEG_QUALITY, FRAME_JPEG_QUALITY])
+            print(f"Frame saved: {frame_path}")
+        return frame
+    except Exception as e:
+        print(f"Error capturing frame: {e}")
+        return None
+
 def record_video(filename_base):
-    """Records a 10-second video and saves it as a web-safe MP4."""
+    """Records a 10-second web-safe MP4 from the running camera."""
+    global camera
     print(f"Recording {VIDEO_DURATION_MS}ms video...")
     os.makedirs(CAPTURE_DIR, exist_ok=True)
     
-    # Define paths
-    raw_video_path = os.path.join(CAPTURE_DIR, f"{filename_base}.h264")
+    # Define path
     final_video_path = os.path.join(CAPTURE_DIR, f"{filename_base}.mp4")
     
-    # 1. Record the raw H.264 stream
-    record_command = [
-        "rpicam-vid",
-        "-t", str(VIDEO_DURATION_MS),
-        "--width", "1280",
-        "--height", "720",
-        "-o", raw_video_path
-    ]
-    
+    # PyAV muxes the hardware H.264 stream straight into MP4, so there is
+    # no raw file to re-wrap.
     try:
-        subprocess.run(record_command, check=True)
-        print(f"Raw video saved: {raw_video_path}")
+        camera.start_encoder(H264Encoder(), PyavOutput(final_video_path))
+        try:
+            time.sleep(VIDEO_DURATION_MS / 1000)
+        finally:
+            camera.stop_encoder()
+        print(f"MP4 video saved: {final_video_path}")
     except Exception as e:
         print(f"Error recording video: {e}")
         return None
 
-    # 2. Re-wrap the raw stream into an MP4 container using ffmpeg
-    print(f"Converting {raw_video_path} to {final_video_path}...")
-    convert_command = [
-        "ffmpeg",
-        "-i", raw_video_path,
-        "-c:v", "copy",
-        "-y",
-        final_video_path
-    ]
-    
-    try:
-        # Hide the ffmpeg output to keep the log clean
-        subprocess.run(convert_command, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        print(f"MP4 conversion successful: {final_video_path}")
-    except Exception as e:
-        print(f"Error converting video to MP4: {e}")
-        return None
-        
-    # 3. Clean up the raw .h264 file
-    try:
-        os.remove(raw_video_path)
-        print(f"Cleaned up {raw_video_path}")
-    except Exception as e:
-        print(f"Warning: could not delete raw video file: {e}")
-
-    # 4. Return the path to the final MP4
     return final_video_path
 
-def extract_frame(video_path, frame_path):
-    """Extracts the first frame from the video for analysis."""
-    print(f"Extracting frame from {video_path}...")
+def edgetpu_available():
+    """Checks whether a Coral Edge TPU and its runtime are present."""
     try:
-        command = [
-            "ffmpeg",
-            "-i", video_path,
-            "-vframes", "1",
-            "-q:v", "2", # High quality
-            frame_path
-        ]
-        subprocess.run(command, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        print(f"Frame saved: {frame_path}")
-        return frame_path
-    except Exception as e:
-        print(f"Error extracting frame: {e}")
-        return None
-def run_animal_detection(frame_path):
+        from tflite_runtime.interpreter import load_delegate
+        load_delegate("libedgetpu.so.1")
+        return True
+    except Exception:
+        return False
+
+def load_model():
+    """Loads YOLOv8n on the Edge TPU if one is attached, otherwise the NCNN build on the CPU."""
+    global model, animal_mask, class_labels
+    if os.path.exists(EDGETPU_MODEL_FILE) and edgetpu_available():
+        # ultralytics picks up the libedgetpu delegate itself for *_edgetpu.tflite
+        # files, so the detection code below works unchanged
+        print("Loading YOLOv8n model (Edge TPU)...")
+        model = YOLO(EDGETPU_MODEL_FILE, task="detect")
+    else:
+        print("Loading YOLOv8n model (CPU)...")
+        model = YOLO(MODEL_FILE, task="detect")
+
+    # Resolve class names once here so detection only does array lookups
+    animal_names = set(ANIMAL_CLASSES)
+    animal_mask = np.array([model.names[i] in animal_names for i in range(len(model.names))])
+    class_labels = [model.names[i].capitalize() for i in range(len(model.names))]
+
+    # The first inference pays for backend setup and memory allocation,
+    # so spend that on a blank frame now rather than on the first trigger
+    print("Warming up model...")
+    model(np.zeros((FRAME_SIZE[1], FRAME_SIZE[0], 3), dtype=np.uint8),
+          imgsz=DETECTION_IMGSZ, half=True, conf=DETECTION_CONF, verbose=False)
+    # Same for the JIT-compiled box filter (a no-op once numba has cached it)
+    best_animal(np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32), animal_mask)
+    print("YOLOv8n model loaded.")
+
+@njit(cache=True)
+def best_animal(class_ids, confidences, animal_mask):
+    """Returns the index and confidence of the most confident animal box, or (-1, 0.0)."""
+    best_i = -1
+    best = 0.0
+    for i in range(class_ids.size):
+        if animal_mask[class_ids[i]] and confidences[i] > best:
+            best = confidences[i]
+            best_i = i
+    return best_i, best
+
+def run_animal_detection(frame):
     """Runs YOLOv8 model on the frame and classifies."""
     global model
-    print(f"Analyzing frame with YOLOv8: {frame_path}...")
+    print("Analyzing frame with YOLOv8...")
     
-    results = model(frame_path, verbose=False) 
+    results = model(frame, imgsz=DETECTION_IMGSZ, half=True, conf=DETECTION_CONF, verbose=False)
     
     best_detection = {"is_animal": False, "class": "False Positive", "confidence": 0.0}
     
     for r in results:
-        for box in r.boxes:
-            class_id = int(box.cls[0])
-            class_name = model.names[class_id]
-            confidence = float(box.conf[0])
-            
-            if class_name in ANIMAL_CLASSES and confidence > best_detection["confidence"]:
-                best_detection["is_animal"] = True
-                best_detection["class"] = class_name.capitalize()
-                best_detection["confidence"] = confidence
+        # Hand the raw arrays to the compiled filter instead of looping in Python
+        class_ids = r.boxes.cls.cpu().numpy().astype(np.int64)
+        confidences = r.boxes.conf.cpu().numpy()
+        best, confidence = best_animal(class_ids, confidences, animal_mask)
+        
+        if best >= 0 and confidence > best_detection["confidence"]:
+            best_detection["is_animal"] = True
+            best_detection["class"] = class_labels[class_ids[best]]
+            best_detection["confidence"] = float(confidence)
     
     print(f"AI Result: {best_detection}")
     return best_detection
 
-def send_notification(result, frame_path):
+def send_notification(result, frame):
     """Sends a push notification via ntfy.sh."""
     print("Sending notification...")
     try:
         title = f"Animal Detected: {result['class']}"
         message = f"Confidence: {result['confidence'] * 100:.1f}%"
         
-        with open(frame_path, 'rb') as f:
-            requests.post(
-                f"https://ntfy.sh/{NTFY_TOPIC}",
-                data=f.read(),
-                headers={
-                    "Title": title,
-                    "Message": message,
-                    "filename": "detection.jpg"
-                }
-            )
+        # Encode the in-memory frame here, on the notification thread
+        _, jpeg = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, FRAME_JPEG_QUALITY])
+        http_session.post(
+            f"https://ntfy.sh/{NTFY_TOPIC}",
+            data=jpeg.tobytes(),
+            headers={
+                "Title": title,
+                "Message": message,
+                "filename": "detection.jpg"
+            }
+        )
         print("Notification sent.")
     except Exception as e:
         print(f"Error sending notification: {e}")
-# --- 3. MQTT Handlers ---
-def on_connect(client, userdata, flags, rc, properties=None):
-    if rc == 0:
-        print("Connected to MQTT Broker.")
-        client.subscribe(TRIGGER_TOPIC)
-        print(f"Waiting for trigger on {TRIGGER_TOPIC}...")
-    else:
-        print(f"Failed to connect, return code {rc}")
+# --- 3. Processing Pipeline ---
+# Capture and detection each run in their own thread and hand work on
+# through bounded queues. A trigger is checked on a single preview frame
+# first, and only confirmed animals get a 10-second recording, so false
+# triggers (wind, shadows) are done in a fraction of a second. A full
+# queue blocks the stage before it.
+trigger_q = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+frame_q = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
 
-def on_message(client, userdata, msg):
-    """Main callback triggered by Arduino."""
+# Only the video encoder needs exclusive use of the camera; preview frames,
+# detection, notifications and saving carry on while a clip records.
+camera_sem = threading.BoundedSemaphore(1)
+# The clip in progress while camera_sem is held: a Future that resolves to its
+# video path (None if recording failed), and when it will stop. recording_lock
+# makes taking the camera and publishing these one step for other threads.
+recording_lock = threading.Lock()
+current_recording = None
+current_recording_end = 0.0
+
+def save_capture(job, video_path):
+    """Builds the database row for a processed trigger and queues it for saving."""
+    ai_result = job["ai_result"]
+    sensor_data = job["sensor_data"]
+    save_to_db({
+        "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "classification": ai_result["class"],
+        "confidence": ai_result["confidence"],
+        "video_path": video_path,
+        "temp": sensor_data.get("temp"),
+        "humidity": sensor_data.get("humidity"),
+        "battery": sensor_data.get("battery"),
+        "light_state": sensor_data.get("light_state")
+    })
+
+def capture_worker():
+    """Stage 1: captures a preview frame for each trigger."""
+    while True:
+        payload = trigger_q.get()
+        print("\n--- TRIGGER RECEIVED ---")
+        try:
+            # 1. Get sensor data from payload (orjson parses the raw bytes directly)
+            sensor_data = orjson.loads(payload)
+            print(f"Payload: {sensor_data}")
 
-    # --- NEW: Check the lock ---
-    global is_processing
-    if is_processing:
-        print("\n--- BUSY: Ignoring trigger, processing in progress. ---")
-        return # Exit immediately
+            # 2. Define filenames
+            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+            frame_path = os.path.join(CAPTURE_DIR, f"frame_{timestamp}.jpg") if SAVE_FRAMES else None
 
-    # --- NEW: Set the lock ---
-    is_processing = True
+            # 3. Capture preview frame
+            frame = capture_frame(frame_path)
+            if frame is None:
+                continue # Error is printed inside function
 
-    print("\n--- TRIGGER RECEIVED ---")
+            frame_q.put({
+                "sensor_data": sensor_data,
+                "timestamp": timestamp,
+                "frame": frame
+            })
+        except Exception as e:
+            print(f"Error in capture stage: {e}")
+
+def detect_worker():
+    """Stage 2: runs the AI on each preview frame and starts recording for animals."""
+    while True:
+        job = frame_q.get()
+        try:
+            # 4. Run AI
+            job["ai_result"] = run_animal_detection(job["frame"])
+
+            # 5. False positives are logged without a video and end here
+            if not job["ai_result"]["is_animal"]:
+                save_capture(job, None)
+                print("--- TASK COMPLETE ---")
+                continue
+
+            threading.Thread(target=record_capture, args=(job,), daemon=True).start()
+        except Exception as e:
+            print(f"Error in detection stage: {e}")
+
+def record_capture(job):
+    """Notifies, records or joins a clip, and saves a confirmed animal."""
+    global current_recording, current_recording_end
     try:
-        # 1. Get sensor data from payload
-        payload = msg.payload.decode('utf-8')
-        print(f"Payload: {payload}")
-        sensor_data = json.loads(payload)
-
-        # 2. Define filenames
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        video_filename_base = f"vid_{timestamp}" # No .mp4 extension
-        frame_filename = f"frame_{timestamp}.jpg"
-
-        # 3. Record video
-        video_path = record_video(video_filename_base) # Pass the base name
-        if not video_path:
-            return # Error is printed inside function
-
-        # 4. Extract frame
-        frame_path = os.path.join(CAPTURE_DIR, frame_filename)
-        if not extract_frame(video_path, frame_path):
-            return # Error is printed inside function
-
-        # 5. Run AI
-        ai_result = run_animal_detection(frame_path)
-
-        # 6. Prepare data for database
-        db_data = {
-            "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-            "classification": ai_result["class"],
-            "confidence": ai_result["confidence"],
-            "video_path": video_path,
-            "temp": sensor_data.get("temp"),
-            "humidity": sensor_data.get("humidity"),
-            "battery": sensor_data.get("battery"),
-            "light_state": sensor_data.get("light_state")
-        }
-
-        # 7. Save to DB
-        save_to_db(db_data)
-
-        # 8. Send notification (only if animal)
-        if ai_result["is_animal"]:
-            send_notification(ai_result, frame_path)
+        # 6. Send notification in the background while the video records
+        notify_executor.submit(send_notification, job["ai_result"], job["frame"])
 
-        print("--- TASK COMPLETE ---")
+        # 7. Record video. If a clip is already running with enough time left,
+        #    this animal is in it, so use that clip's result. If it is about to
+        #    stop, wait for it and record a follow-up clip instead.
+        owner = False
+        while True:
+            with recording_lock:
+                if camera_sem.acquire(blocking=False):
+                    owner = True
+                    recording = current_recording = Future()
+                    current_recording_end = time.monotonic() + VIDEO_DURATION_MS / 1000
+                    break
+                recording = current_recording
+                remaining_ms = (current_recording_end - time.monotonic()) * 1000
+            if remaining_ms >= MIN_LINKED_CLIP_MS:
+                break
+            recording.result() # Clip is nearly over; wait for the camera
+
+        if owner:
+            video_path = None
+            try:
+                video_path = record_video(f"vid_{job['timestamp']}") # No .mp4 extension
+            finally:
+                with recording_lock:
+                    current_recording = None
+                    camera_sem.release()
+                recording.set_result(video_path)
+        else:
+            print("Camera busy, linking to clip in progress.")
+            video_path = recording.result() # None if that recording failed
+
+        # 8. Save to DB (even if recording failed, so the sighting is kept)
+        save_capture(job, video_path)
 
+        print("--- TASK COMPLETE ---")
     except Exception as e:
-        print(f"Error in on_message: {e}")
+        print(f"Error in record stage: {e}")
 
-    # --- NEW: Release the lock in a 'finally' block ---
-    finally:
-        print(f"Cooldown started... waiting 10 seconds.")
-        time.sleep(10) # <-- YOUR 10 SECOND GAP
-        is_processing = False # Unlock for the next trigger
-        print("System is ready for new trigger.")
-# --- 4. Main Execution ---
+def start_pipeline():
+    """Starts one background thread per pipeline stage."""
+    for worker in (capture_worker, detect_worker):
+        threading.Thread(target=worker, name=worker.__name__, daemon=True).start()
+    print("Processing pipeline started.")
+
+# --- 4. MQTT Handlers ---
+def on_connect(client, userdata, flags, reason_code, properties):
+    if not reason_code.is_failure:
+        print("Connected to MQTT Broker.")
+        client.subscribe(TRIGGER_TOPIC)
+        print(f"Waiting for trigger on {TRIGGER_TOPIC}...")
+    else:
+        print(f"Failed to connect, reason: {reason_code}")
+
+def on_message(client, userdata, msg):
+    """Main callback triggered by Arduino; hands the trigger to the pipeline."""
+    try:
+        trigger_q.put_nowait(msg.payload)
+    except queue.Full:
+        print("\n--- BUSY: Pipeline is full, ignoring trigger. ---")
+# --- 5. Main Execution ---
 if __name__ == "__main__":
+    client = None
     try:
         # Load AI model
-        print("Loading YOLOv8n model...")
-        model = YOLO(MODEL_FILE)
-        print("YOLOv8n model loaded.")
+        load_model()
         
-        # Initialize database
+        # Initialize database and start the batched writer
         init_db()
+        start_db_flusher()
+
+        # Open the camera
+        init_camera()
+
+        # Start the capture -> detect -> record stages
+        start_pipeline()
 
         # Start MQTT client
         print("Processor script running...")
-        client = mqtt.Client(client_id="rpi_processor", callback_api_version=mqtt.CallbackAPIVersion.VERSION1)
+        client = mqtt.Client(client_id="rpi_processor", callback_api_version=mqtt.CallbackAPIVersion.VERSION2)
         client.on_connect = on_connect
         client.on_message = on_message
-        client.connect(MQTT_BROKER, MQTT_PORT, 60)
-        client.loop_forever()
+        client.connect(MQTT_BROKER, MQTT_PORT, MQTT_KEEPALIVE)
+        # The network loop gets its own thread, so nothing in the pipeline
+        # can hold up PINGs to the broker
+        client.loop_start()
+
+        while True:
+            time.sleep(1)
         
     except KeyboardInterrupt:
         print("\nShutting down...")
     except Exception as e:
         print(f"Main loop error: {e}")
+    finally:
+        # Stop taking triggers and write out whatever is still queued
+        if client is not None:
+            client.loop_stop()
+            client.disconnect()
+        flush_db()
 
@@ -10,6 +10,7 @@ DATABASE_FILE = "/home/param/wildlife_log.db"
 CAPTURE_DIR = "/home/param/captures"
 HOST_IP = "0.0.0.0" # Listen on all network interfaces
 HOST_PORT = 5000
+MAX_CAPTURES_SHOWN = 100  # Newest captures listed on the dashboard
 
 app = Flask(__name__)
 
@@ -19,6 +20,11 @@ def get_db():
     if db is None:
         db = g._database = sqlite3.connect(DATABASE_FILE)
         db.row_factory = sqlite3.Row  # This lets us access columns by name
+        # The controller puts the file in WAL mode; these keep reads cheap on the SD card
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.execute("PRAGMA cache_size=-8000")  # ~8 MB page cache
+        db.execute("PRAGMA temp_store=MEMORY")
+        db.execute("PRAGMA mmap_size=67108864")  # 64 MB of memory-mapped reads
     return db
 
 @app.teardown_appcontext
@@ -33,11 +39,17 @@ def index():
     try:
         cur = get_db().cursor()
         
-        # --- THIS IS THE ORIGINAL QUERY ---
-        # It selects *all* entries, including False Positives.
-        cur.execute(
-            "SELECT * FROM captures ORDER BY id DESC"
-        )
+        # Newest entries first, including False Positives. Only the newest
+        # rows are shown, so only fetch those. id is the rowid, so
+        # ORDER BY id DESC LIMIT walks the table b-tree backwards and stays
+        # fast however large the history grows.
+        cur.execute("""
+            SELECT id, timestamp, classification, confidence, video_path,
+                   temp, humidity, battery, light_state
+            FROM captures
+            ORDER BY id DESC
+            LIMIT ?
+        """, (MAX_CAPTURES_SHOWN,))
         
         captures = cur.fetchall()
         
@@ -60,8 +72,9 @@ def index():
 @app.route('/captures/<filename>')
 def serve_capture(filename):
     try:
-        # --- THIS IS THE CORRECTED LINE ---
-        return send_from_directory(CAPTURE_DIR, filename)
+        # conditional=True honours HTTP Range requests so the browser can seek
+        # in the video. In production nginx serves /captures/ directly (see README).
+        return send_from_directory(CAPTURE_DIR, filename, conditional=True)
     except Exception as e:
         return f"Error serving file: {e}"
 